@@ -24,7 +24,8 @@
 
 import re
 import sys
-from typing import Dict
+import multiprocessing
+from typing import Callable, Dict, Iterable, Iterator, Optional, TextIO, Union
 
 
 class BBCodeToMarkdown:
@@ -58,23 +59,33 @@ class BBCodeToMarkdown:
     # GitHub usernames. Any mapping that results in an empty string, plus any mention not in the mapping,
     # have their "@" signs removed, to avoid mentioning someone inadvertently.
 
+    # The conversion passes, in the order they are run
+    passes = [
+        "strip_unsupported",
+        "bold",
+        "italic",
+        "size",
+        "list",
+        "code",
+        "quote",
+        "hr",
+        "url",
+        "email",
+        "img",
+        "mentions",
+    ]
+
     def __init__(self, bbcode: str, mention_map: Dict[str, str] = {}):
         self.text = bbcode
         self.mention_map = mention_map
 
-    def md(self) -> str:
-        self.strip_unsupported()
-        self.bold()
-        self.italic()
-        self.size()
-        self.list()
-        self.code()
-        self.quote()
-        self.hr()
-        self.url()
-        self.email()
-        self.img()
-        self.mentions()
+    def md(self, on_pass: Optional[Callable[[int], None]] = None) -> str:
+        """Run all of the conversion passes and return the result. If on_pass is given, it is called with
+        the index of each pass (in BBCodeToMarkdown.passes) before that pass is run."""
+        for index, name in enumerate(BBCodeToMarkdown.passes):
+            if on_pass is not None:
+                on_pass(index)
+            getattr(self, name)()
         return self.text
 
     def strip_unsupported(self):
@@ -223,6 +234,126 @@ class BBCodeToMarkdown:
         self.text = finished_string
 
 
+def plain_text(text: str) -> str:
+    """Fallback for text that cannot be converted: present it verbatim in a code block, fenced with more
+    backticks than the text itself ever has in a row. Unlike the conversion, this is linear in the length
+    of the text, and it also keeps any @mentions in the text from notifying anyone."""
+    longest_run = max((len(run) for run in re.findall("`+", text)), default=0)
+    fence = "`" * max(3, longest_run + 1)
+    return f"{fence}\n{text}\n{fence}\n"
+
+
+# Some malformed BBCode makes the regular expressions backtrack for minutes, and a regular expression
+# cannot be interrupted, so conversions with a time budget are run in a worker process that can be
+# killed instead. The worker reports the pass it is running through a shared value.
+_worker_pool = None
+_worker_current_pass = None
+
+
+def _init_worker(current_pass):
+    global _worker_current_pass
+    _worker_current_pass = current_pass
+
+
+def _set_worker_current_pass(index: int):
+    _worker_current_pass.value = index
+
+
+def _convert_in_worker(text: str, mention_map: Dict[str, str]) -> str:
+    return BBCodeToMarkdown(text, mention_map).md(_set_worker_current_pass)
+
+
+def convert_with_budget(
+    text: str,
+    mention_map: Dict[str, str] = {},
+    time_budget: Optional[float] = None,
+    context: str = "text",
+) -> str:
+    """Convert text, giving up after time_budget seconds and falling back to plain_text(). The context
+    describes the text in the warning printed when that happens. With no time budget, this is the same
+    as BBCodeToMarkdown(text, mention_map).md()."""
+    global _worker_pool, _worker_current_pass
+    if not time_budget:
+        return BBCodeToMarkdown(text, mention_map).md()
+
+    if _worker_pool is None:
+        _worker_current_pass = multiprocessing.Value("i", 0)
+        _worker_pool = multiprocessing.Pool(
+            1, initializer=_init_worker, initargs=(_worker_current_pass,)
+        )
+    result = _worker_pool.apply_async(_convert_in_worker, (text, mention_map))
+    try:
+        return result.get(time_budget)
+    except multiprocessing.TimeoutError:
+        pass_name = BBCodeToMarkdown.passes[_worker_current_pass.value]
+        _worker_pool.terminate()
+        _worker_pool = None
+        print(
+            f"WARNING: converting {context} took more than {time_budget} seconds (in the '{pass_name}' pass), using it as plain text instead",
+            flush=True,
+        )
+        return plain_text(text)
+
+
+# Only these tags are converted by patterns that can span lines: every other conversion works on a
+# single line at a time. A blank line outside of any of these tags is therefore a safe place to split
+# the text into pieces that can be converted independently.
+_STREAM_SPLIT_POINT = re.compile(
+    r"(\n\n)|\[(/?)(list|code|quote)\b[^\]\n]*\]", flags=re.IGNORECASE
+)
+
+
+def convert_stream(
+    source: Union[Iterable[str], TextIO],
+    mention_map: Dict[str, str] = {},
+    convert: Optional[Callable[[str], str]] = None,
+    max_buffer: int = 1024 * 1024,
+) -> Iterator[str]:
+    """Convert text arriving in chunks (or read from a file), yielding the Markdown a piece at a time.
+    Text is held back only while one of the multi-line tags is open, or until the next blank line, so
+    memory use does not depend on the length of the whole text. If a tag is left open for more than
+    max_buffer characters it is given up on, and the text so far is converted without it being closed.
+    By default each piece is converted with BBCodeToMarkdown(piece, mention_map).md(); pass convert to
+    do something else (e.g. convert_with_budget())."""
+    if convert is None:
+        convert = lambda piece: BBCodeToMarkdown(piece, mention_map).md()
+    if hasattr(source, "read"):
+        file = source
+        source = iter(lambda: file.read(65536), "")
+
+    buffer = ""
+    scanned = 0  # Everything in the buffer before this has been checked for tags
+    open_tags = {}  # Nesting depth of each multi-line tag
+    split_point = 0  # The last safe place found to split the buffer
+    for chunk in source:
+        buffer += chunk
+        # Tags never span lines, so the text can be checked up to the last newline
+        end = buffer.rfind("\n") + 1
+        for match in _STREAM_SPLIT_POINT.finditer(buffer, scanned, end):
+            if match.group(1):
+                if not any(open_tags.values()):
+                    split_point = match.start() + 1
+            else:
+                tag = match.group(3).lower()
+                if match.group(2):
+                    open_tags[tag] = max(0, open_tags.get(tag, 0) - 1)
+                else:
+                    open_tags[tag] = open_tags.get(tag, 0) + 1
+        # Back up one character in case this newline turns out to be the first of a blank line
+        scanned = max(scanned, end - 1)
+
+        if split_point == 0 and len(buffer) > max_buffer:
+            split_point = end if end > 0 else len(buffer)
+            open_tags.clear()
+        if split_point > 0:
+            yield convert(buffer[:split_point])
+            buffer = buffer[split_point:]
+            scanned = max(0, scanned - split_point)
+            split_point = 0
+    if buffer:
+        yield convert(buffer)
+
+
 def selftest():
     text = """
 Some text. [b]Some bold text[/b]. [i]Some italic text[/i].
@@ -291,6 +422,12 @@ if __name__ == "__main__":
     text = sys.argv[1]
     if text == "selftest":
         selftest()
+    elif text == "-":
+        # Convert stdin to stdout, a piece at a time
+        sys.stdin.reconfigure(encoding="utf-8")
+        sys.stdout.reconfigure(encoding="utf-8")
+        for md in convert_stream(sys.stdin):
+            sys.stdout.write(md)
     else:
         b = BBCodeToMarkdown(text)
         print(b.md())
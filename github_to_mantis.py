@@ -35,6 +35,12 @@ MANTIS_REPORTERID='' # The numeric user ID to assign these posts to
 BUG_MAP_CSV='' # The path to the CSV file with the mapping in it
 
 #############################################################################
+# OPTIONAL CONFIGURATION SETTINGS
+
+MANTIS_MIGRATED_STATUS=90 # The status to set migrated bugs to (80 is "resolved", 90 is "closed"), or None to leave them alone
+MANTIS_UPDATE_CHUNK_SIZE=1000 # The number of bugs whose status is updated in each transaction
+
+#############################################################################
 
 
 
@@ -68,6 +74,39 @@ def add_mantis_note(mantis_id, github_id):
     sql_reference = "INSERT INTO mantis_bugnote_table (id,bug_id,reporter_id,bugnote_text_id,view_state,note_type,note_attr,time_tracking,last_modified,date_submitted) VALUES (NULL,%s,%s,LAST_INSERT_ID(),%s,%s,NULL,%s,%s,%s)"
     cursor.execute(sql_reference, bugnote_data)
 
+def set_mantis_status(mantis_ids, status):
+    """Set the status of all of the given bugs, recording the change in each bug's history. Rather than
+    one statement per bug, each chunk of bugs is updated with one statement for the bug table and one
+    (multi-row) insert for the history table, in a transaction of its own."""
+    start = time.perf_counter()
+    updated = 0
+    for chunk_start in range(0, len(mantis_ids), MANTIS_UPDATE_CHUNK_SIZE):
+        chunk = mantis_ids[chunk_start:chunk_start + MANTIS_UPDATE_CHUNK_SIZE]
+        placeholders = ",".join(["%s"] * len(chunk))
+        try:
+            # Lock the rows while we work out which ones actually change, so the history is accurate
+            sql_current = f"SELECT id,status FROM mantis_bug_table WHERE id IN ({placeholders}) FOR UPDATE"
+            cursor.execute(sql_current, chunk)
+            changed = [(bug_id, old_status) for bug_id, old_status in cursor.fetchall() if old_status != status]
+            if changed:
+                now = int(time.time())
+                history_data = [(MANTIS_REPORTERID,bug_id,"status",str(old_status),str(status),0,now) for bug_id, old_status in changed]
+                sql_history = "INSERT INTO mantis_bug_history_table (id,user_id,bug_id,field_name,old_value,new_value,type,date_modified) VALUES (NULL,%s,%s,%s,%s,%s,%s,%s)"
+                cursor.executemany(sql_history, history_data)
+
+                changed_ids = [bug_id for bug_id, _ in changed]
+                changed_placeholders = ",".join(["%s"] * len(changed_ids))
+                sql_update = f"UPDATE mantis_bug_table SET status=%s,last_updated=%s WHERE id IN ({changed_placeholders})"
+                cursor.execute(sql_update, (status, now, *changed_ids))
+            connection.commit()
+            updated += len(changed)
+        except mysql.connector.Error as e:
+            connection.rollback()
+            print (f"Failed to update the status of Mantis bugs {chunk[0]} to {chunk[-1]}: {str(e)}. Continuing...")
+        print (f"Updated the status of {updated} Mantis bugs in {time.perf_counter() - start:.2f} seconds")
+
+migrated_ids = []
+start = time.perf_counter()
 with open (BUG_MAP_CSV, "r") as f:
     lines = f.readlines()
     for line in lines:
@@ -77,10 +116,15 @@ with open (BUG_MAP_CSV, "r") as f:
                 m = int(mantis_id)
                 g = int(github_id)
                 add_mantis_note(m, g)
+                migrated_ids.append(m)
             except Exception as e:
                 print (f"Failed to create note in Mantis bug {mantis_id}, for GitHub bug {github_id}: {str(e)}. Continuing...")
 
 connection.commit()
+print (f"Added notes to {len(migrated_ids)} Mantis bugs in {time.perf_counter() - start:.2f} seconds")
+
+if MANTIS_MIGRATED_STATUS is not None:
+    set_mantis_status(migrated_ids, MANTIS_MIGRATED_STATUS)
 cursor.close()
 connection.close()
 
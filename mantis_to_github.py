@@ -23,6 +23,7 @@
 # ***************************************************************************
 
 import os
+import re
 import json
 import csv
 import sys
@@ -34,9 +35,14 @@ import urllib.error
 import urllib.response
 import urllib.parse
 import time
-from typing import Dict, List, Optional
+import tempfile
+import base64
+import shutil
+import threading
+import concurrent.futures
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
-from bbcode_to_markdown import BBCodeToMarkdown
+from bbcode_to_markdown import BBCodeToMarkdown, convert_stream, convert_with_budget, plain_text
 
 #########################################################################################
 #                                     CONFIGURATION                                     #
@@ -53,6 +59,69 @@ MANTIS_ATTACHMENTS_TABLE = "./mantis_bug_file_table.csv"
 # matching the MANTIS_ATTACHMENTS_TABLE database export
 MANTIS_ATTACHMENTS_DIR = "./attachments/"
 
+# Malformed BBCode can make the converter take minutes on a single field. Converting any one field is
+# given this many seconds, after which the field is included as plain text instead. None disables this.
+BBCODE_TIME_BUDGET = 30
+
+# Attachments are uploaded before the migration by running "python mantis_to_github.py attachments".
+# Each unique file is uploaded only once, however many tickets it is attached to, and its link is
+# recorded in ATTACHMENT_MANIFEST. The migration then links every ticket's attachments from its issue.
+ATTACHMENT_MANIFEST = "attachment_manifest.json"
+
+# Where the attachments are uploaded to: "github" commits them to GITHUB_ATTACHMENTS_BRANCH of the
+# GitHub repo (via the git data API), "local" copies them to LOCAL_ATTACHMENTS_DIR, which is expected
+# to be served at LOCAL_ATTACHMENTS_URL (e.g. by rsyncing it to a web server or object store).
+ATTACHMENT_STORE = "github"
+GITHUB_ATTACHMENTS_BRANCH = "mantis-attachments"
+LOCAL_ATTACHMENTS_DIR = "./uploaded_attachments/"
+LOCAL_ATTACHMENTS_URL = "https://tracker.freecad.org/attachments/"
+
+# Number of attachments uploaded at once
+ATTACHMENT_UPLOAD_THREADS = 4
+
+# Uploaded attachments are committed to the store, and recorded in the manifest, after every this many
+# uploads, so that an interrupted upload run loses at most this many uploads
+ATTACHMENT_COMMIT_BATCH_SIZE = 100
+
+# Uploading to GitHub does not create notifications, so it is not subject to the issue-creation throttle
+# that GITHUB_BATCH_PAUSE works around: uploads only need to stay under GitHub's limit of 80 content-
+# creating requests per minute. Set GITHUB_UPLOAD_BATCH_SIZE to 0 to disable the pause between batches.
+GITHUB_UPLOAD_REQUEST_INTERVAL = 0.75
+GITHUB_UPLOAD_BATCH_SIZE = 0
+GITHUB_UPLOAD_BATCH_PAUSE = 0
+
+# GitHub rejects issue bodies longer than this many characters. Longer bodies are cut short, with a
+# note saying so (the full text remains available in the original Mantis ticket).
+GITHUB_MAX_BODY_LENGTH = 65536
+
+# Some tickets have enormous text fields (usually pasted logs). Any field longer than this many characters
+# is written to a temporary file while the export is being read, instead of being held in memory, and
+# only as much of it as could fit in the issue body is ever read back.
+MANTIS_LARGE_FIELD_THRESHOLD = GITHUB_MAX_BODY_LENGTH
+
+# The Mantis instance the export came from: migrated issues link back to it, and links to it found
+# in the migrated text are rewritten to point at the corresponding GitHub issue (see "relink" below)
+MANTIS_TRACKER_URL = "https://tracker.freecad.org"
+
+# Each successfully-migrated issue is appended to this file as a "mantis_id,github_number" line
+MIGRATION_RESULTS_FILE = "migration_results.csv"
+
+# Issues that could not be migrated are appended to this file, one JSON object per line, together with
+# the payload that was sent and the error that came back, so that the rest of the run can carry on.
+# Run "python mantis_to_github.py retry" to replay them.
+DEAD_LETTER_FILE = "migration_dead_letters.jsonl"
+
+# The "verify" command lists every issue in the GitHub repo. The pages of that listing are cached here,
+# along with their ETags, so that pages which have not changed since the last run cost no API quota.
+GITHUB_ISSUE_LIST_CACHE = "github_issue_list_cache.json"
+
+# Write requests (issue creation and editing, in the migration, "retry" and "relink") are spaced out to
+# stay under GitHub's secondary rate limiter: wait GITHUB_REQUEST_INTERVAL seconds between requests, and
+# GITHUB_BATCH_PAUSE seconds after every GITHUB_BATCH_SIZE requests.
+GITHUB_REQUEST_INTERVAL = 1
+GITHUB_BATCH_SIZE = 10
+GITHUB_BATCH_PAUSE = 60
+
 # The real values for the final import
 GITHUB_REPO_OWNER = "FreeCAD"
 GITHUB_REPO_NAME = "FreeCAD"
@@ -124,8 +193,200 @@ MANTIS_PROJECT_TO_GITHUB_LABEL_MAP = {
 #########################################################################################
 
 
+class LargeField:
+    """The text of a single oversized CSV field, stored in a temporary file instead of in memory."""
+
+    def __init__(self, text: str = ""):
+        self.file = tempfile.TemporaryFile(mode="w+", encoding="utf-8", newline="\n")
+        self.file.write(text)
+
+    def append(self, text: str):
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(text)
+
+    def contains(self, text: str) -> bool:
+        """Equivalent to text in self.read(), reading only a chunk at a time."""
+        previous = ""
+        for chunk in self.chunks():
+            # Keep the end of the previous chunk, in case the text straddles the two
+            if text in previous[-len(text) :] + chunk:
+                return True
+            previous = chunk
+        return False
+
+    def read(self, limit: Optional[int] = None) -> str:
+        """Read the text back, or only its first limit characters."""
+        self.file.seek(0)
+        return self.file.read(limit)
+
+    def chunks(self, limit: Optional[int] = None) -> Iterator[str]:
+        """Read the text (or only its first limit characters) back a chunk at a time."""
+        self.file.seek(0)
+        remaining = limit
+        while remaining is None or remaining > 0:
+            chunk = self.file.read(65536 if remaining is None else min(65536, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+    def split_reversed(
+        self, separator_line: str, limit: Optional[int] = None
+    ) -> Iterator[str]:
+        """Equivalent to reversed(text.split("\n" + separator_line + "\n")), but only ever holds one
+        of the pieces in memory. If limit is given, each piece is cut short after that many characters."""
+        separator = separator_line + "\n"
+        pieces = []  # (file position, length) of each piece
+        self.file.seek(0)
+        start = self.file.tell()
+        length = 0
+        previous_line_was_separator = False
+        while True:
+            line = self.file.readline()
+            if not line:
+                break
+            if line == separator and length > 0 and not previous_line_was_separator:
+                # The newline preceding the separator line is part of the separator
+                pieces.append((start, length - 1))
+                start = self.file.tell()
+                length = 0
+                previous_line_was_separator = True
+            else:
+                length += len(line)
+                previous_line_was_separator = False
+        pieces.append((start, length))
+        for start, length in reversed(pieces):
+            self.file.seek(start)
+            yield self.file.read(length if limit is None else min(length, limit))
+
+    def close(self):
+        self.file.close()
+
+
+def read_mantis_export(f) -> Iterator[List[Union[str, LargeField]]]:
+    """Read the rows of the Mantis CSV export from the open file f, as csv.reader(f) would, except that
+    any field longer than MANTIS_LARGE_FIELD_THRESHOLD characters is moved to a LargeField while it is
+    being read, instead of being built up in memory first. So however large the export's fields are,
+    only one block of the file and the fields under the threshold are ever held in memory."""
+
+    unquoted_text = re.compile("[^,\r\n]*")
+    row = []
+    field_parts = []  # The text of the field being read, until it grows past the threshold...
+    field_length = 0
+    large_field = None  # ... after which it goes here instead
+    field_started = False  # Whether the field has any text, or was quoted (so is not just missing)
+    state = "start"  # Of a field, or in "unquoted" or "quoted" text, or just after a "quote" in quoted text
+    skip_line_feed = False  # After a "\r", a "\n" is part of the same line ending
+
+    def append(text: str):
+        nonlocal field_length, large_field, field_started
+        if not text:
+            return
+        field_started = True
+        if large_field is not None:
+            large_field.append(text)
+            return
+        field_parts.append(text)
+        field_length += len(text)
+        if field_length > MANTIS_LARGE_FIELD_THRESHOLD:
+            large_field = LargeField("".join(field_parts))
+            field_parts.clear()
+
+    def end_field():
+        nonlocal field_length, large_field, field_started
+        row.append(large_field if large_field is not None else "".join(field_parts))
+        field_parts.clear()
+        field_length = 0
+        large_field = None
+        field_started = False
+
+    while True:
+        block = f.read(65536)
+        if not block:
+            break
+        pos = 0
+        while pos < len(block):
+            if skip_line_feed:
+                skip_line_feed = False
+                if block[pos] == "\n":
+                    pos += 1
+                    continue
+            if state == "start":
+                if block[pos] == '"':
+                    field_started = True
+                    state = "quoted"
+                    pos += 1
+                else:
+                    state = "unquoted"
+            elif state == "unquoted":
+                end = unquoted_text.match(block, pos).end()
+                append(block[pos:end])
+                pos = end
+                if pos == len(block):
+                    continue  # The field carries on in the next block
+                separator = block[pos]
+                pos += 1
+                state = "start"
+                if separator == ",":
+                    end_field()
+                    continue
+                skip_line_feed = separator == "\r"
+                if row or field_started:
+                    end_field()
+                yield row  # Like csv.reader, a blank line is an empty row
+                row = []
+            elif state == "quoted":
+                end = block.find('"', pos)
+                if end == -1:
+                    append(block[pos:])
+                    pos = len(block)
+                else:
+                    append(block[pos:end])
+                    pos = end + 1
+                    state = "quote"
+            else:
+                # Either an escaped quote, or the end of the quoted text (anything after which, up to the
+                # next separator, is still part of the field)
+                if block[pos] == '"':
+                    append('"')
+                    pos += 1
+                    state = "quoted"
+                else:
+                    state = "unquoted"
+    if row or field_started:
+        end_field()
+        yield row
+
+
+def open_code_fence(md: str) -> Optional[str]:
+    """If the Markdown text ends inside a fenced code block, return the fence that opened it."""
+    fence_matcher = re.compile("^ {0,3}(`{3,}|~{3,})(.*)$")
+    fence = None
+    for line in md.split("\n"):
+        match = fence_matcher.match(line)
+        if not match:
+            continue
+        marker, rest = match.groups()
+        if fence is None:
+            if marker[0] == "~" or "`" not in rest:
+                fence = marker
+        elif marker[0] == fence[0] and len(marker) >= len(fence) and not rest.strip():
+            fence = None
+    return fence
+
+
 class Issue:
-    def __init__(self, row_data):
+    # The free-text fields that may be large enough to be worth keeping out of memory
+    large_fields = [
+        "description",
+        "steps_to_reproduce",
+        "additional_information",
+        "notes",
+        "freecad_information",
+    ]
+
+    def __init__(self, row_data, attachments: List[Tuple[str, str]] = []):
         if len(row_data) < 27:
             raise RuntimeError(
                 f"Expected 27 fields in CSV row, found only {len(row_data)}"
@@ -160,6 +421,23 @@ class Issue:
         self.tags = row_data[next(element_index)]
         self.related = row_data[next(element_index)]
         self.freecad_information = row_data[next(element_index)]
+        self.attachments = attachments  # (filename, url) pairs
+        for field, value in list(vars(self).items()):
+            if field in Issue.large_fields:
+                if isinstance(value, str) and len(value) > MANTIS_LARGE_FIELD_THRESHOLD:
+                    setattr(self, field, LargeField(value))
+            elif isinstance(value, LargeField):
+                # Only the free-text fields are kept out of memory: anything else is never that long,
+                # unless the row is malformed, so just cut it short
+                setattr(self, field, value.read(MANTIS_LARGE_FIELD_THRESHOLD))
+                value.close()
+
+    def close(self):
+        """Release the temporary files holding any oversized fields."""
+        for field in Issue.large_fields:
+            value = getattr(self, field)
+            if isinstance(value, LargeField):
+                value.close()
 
     def to_github_api_fields(self) -> Dict[str, str]:
         # GitHub REST API fields for creating an issue:
@@ -186,9 +464,7 @@ class Issue:
 
     def _create_markdown(self) -> str:
         md = ""
-        md += (
-            f"Issue imported from https://tracker.freecad.org/view.php?id={self.id}\n\n"
-        )
+        md += f"Issue imported from {MANTIS_TRACKER_URL}/view.php?id={self.id}\n\n"
         md += f"* **Reporter:** {self.reporter}\n"
         md += f"* **Date submitted:** {self.date_submitted}\n"
         md += f"* **FreeCAD version:** {self.product_version}\n"
@@ -196,23 +472,24 @@ class Issue:
         md += f"* **Status:** {self.status}\n"
         md += f"* **Tags:** {self.tags}\n"
         md += f"\n\n# Original report text\n\n"
-        md += BBCodeToMarkdown(self.description, MANTIS_TO_GITHUB_USERNAME_MAP).md()
+        md += self._convert_field(self.description, "description")
         if self.additional_information:
             md += f"\n\n# Additional information\n\n"
-            md += BBCodeToMarkdown(
-                self.additional_information, MANTIS_TO_GITHUB_USERNAME_MAP
-            ).md()
+            md += self._convert_field(
+                self.additional_information, "additional information"
+            )
         if self.steps_to_reproduce:
             md += f"\n\n# Steps to reproduce\n\n"
-            md += BBCodeToMarkdown(
-                self.steps_to_reproduce, MANTIS_TO_GITHUB_USERNAME_MAP
-            ).md()
+            md += self._convert_field(self.steps_to_reproduce, "steps to reproduce")
         cleaned_freecad_info = self._clean_freecad_info()
         if (
             "Build type" in cleaned_freecad_info
         ):  # "Build type" is one of the strings that should always be there
             md += f"\n\n# FreeCAD Info\n\n"
             md += f"```\n{cleaned_freecad_info}\n```"
+        if self.attachments:
+            md += f"\n\n# Attachments\n\n"
+            md += self._attachment_links()
         md += "\n\n# Other bug information\n\n"
         if self.priority:
             md += f"* **Priority:** {self.priority}\n"
@@ -234,6 +511,8 @@ class Issue:
         #    md += f"* **Resolution:** {self.resolution}\n"
         if self.fixed_in_version:
             md += f"* **Fixed in version:** {self.fixed_in_version}\n"
+        if self.related:
+            md += f"* **Related:** {self.related}\n"
         try:
             num_notes = int(self.num_notes)
         except Exception:
@@ -241,8 +520,78 @@ class Issue:
         if self.notes and num_notes > 0:
             md += f"\n\n# Discussion from Mantis ticket\n\n"
             md += self._process_comments()
+        if len(md) > GITHUB_MAX_BODY_LENGTH:
+            # Don't point at the Mantis ticket here: "relink" would rewrite that into a link to this issue
+            note = "\n\n---\n\n*This ticket was too long to import in full: see the original Mantis ticket linked at the top.*\n"
+            md = md[: GITHUB_MAX_BODY_LENGTH - len(note)]
+            fence = open_code_fence(md)
+            if fence:
+                # Close the code block the text was cut off in, or the note would be part of it
+                md = md[: GITHUB_MAX_BODY_LENGTH - len(note) - len(fence) - 2]
+                md += "\n" + (open_code_fence(md) or "") + "\n"
+            md += note
         return md
 
+    def _convert(self, bbcode: str, field: str, time_budget: Optional[float]) -> str:
+        return convert_with_budget(
+            bbcode,
+            MANTIS_TO_GITHUB_USERNAME_MAP,
+            time_budget,
+            f"the {field} of Mantis issue {self.id}",
+        )
+
+    def _budgeted_converter(self, field: str) -> Callable[[str], str]:
+        """Returns a function converting pieces of the given field that all share one time budget: once it
+        has been used up, the remaining pieces are used as plain text."""
+        if not BBCODE_TIME_BUDGET:
+            return lambda piece: self._convert(piece, field, None)
+
+        deadline = time.monotonic() + BBCODE_TIME_BUDGET
+        budget_exceeded = False
+
+        def convert_piece(piece: str) -> str:
+            nonlocal budget_exceeded
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                return self._convert(piece, field, remaining)
+            if not budget_exceeded:
+                budget_exceeded = True
+                print(
+                    f"WARNING: converting the {field} of Mantis issue {self.id} took more than {BBCODE_TIME_BUDGET} seconds, using the rest of it as plain text instead",
+                    flush=True,
+                )
+            return plain_text(piece)
+
+        return convert_piece
+
+    def _convert_field(self, value: Union[str, LargeField], field: str) -> str:
+        if not isinstance(value, LargeField):
+            return self._convert(value, field, BBCODE_TIME_BUDGET)
+
+        # Convert straight from the temporary file, a piece at a time
+        return "".join(
+            convert_stream(
+                value.chunks(GITHUB_MAX_BODY_LENGTH),
+                MANTIS_TO_GITHUB_USERNAME_MAP,
+                self._budgeted_converter(field),
+            )
+        )
+
+    @staticmethod
+    def _text(value: Union[str, LargeField]) -> str:
+        if isinstance(value, LargeField):
+            return value.read(GITHUB_MAX_BODY_LENGTH)
+        return value
+
+    def _attachment_links(self) -> str:
+        links = ""
+        for filename, url in self.attachments:
+            if os.path.splitext(filename)[1].lower() in [".png", ".jpg", ".jpeg", ".gif"]:
+                links += f"* ![{filename}]({url})\n"
+            else:
+                links += f"* [{filename}]({url})\n"
+        return links
+
     def _map_assignee(self) -> Optional[List[str]]:
         if self.assigned_to in MANTIS_TO_GITHUB_USERNAME_MAP:
             mapped_value = MANTIS_TO_GITHUB_USERNAME_MAP[self.assigned_to]
@@ -270,31 +619,44 @@ Help > About FreeCAD > Copy to clipboard
 NOTE: just the snippet alone will do without anything else included.
 The ticket will not be submitted without it.
 -->"""
-        if self.freecad_information.startswith(text_to_remove):
-            return self.freecad_information[len(text_to_remove) :]
+        freecad_information = self._text(self.freecad_information)
+        if freecad_information.startswith(text_to_remove):
+            return freecad_information[len(text_to_remove) :]
         else:
-            return self.freecad_information
+            return freecad_information
+
+    def _reversed_comments(self) -> Iterable[str]:
+        if isinstance(self.notes, LargeField):
+            return self.notes.split_reversed("=-=", GITHUB_MAX_BODY_LENGTH)
+        return reversed(self.notes.split("\n=-=\n"))
 
     def _process_comments(self) -> str:
-        split_comments = self.notes.split("\n=-=\n")
         comments = ""
         first = True
-        for comment in reversed(split_comments):
+        # All of the notes share the field's time budget, so an issue with many notes cannot take longer
+        # to convert than one with a single long note
+        convert = self._budgeted_converter("notes")
+        for comment in self._reversed_comments():
+            if len(comments) > GITHUB_MAX_BODY_LENGTH:
+                break  # The rest could not fit in the issue body anyway
             if not first:
                 comments += "\n\n---\n\n"
             else:
                 first = False
-            this_comment_text = BBCodeToMarkdown(
-                comment, MANTIS_TO_GITHUB_USERNAME_MAP
-            ).md()
-            comment_lines = this_comment_text.split("\n")
-            first_line = True
-            for comment_line in comment_lines:
-                if first_line:
-                    first_line = False
-                    comments += "### Comment by " + comment_line + "\n"
-                else:
-                    comments += comment_line + "\n"
+            # The first line of each note names its author: build the heading from it directly (only handling
+            # its @mentions), so that if the rest of the note falls back to plain text, the fence starts below
+            # the heading instead of replacing it.
+            author, newline, text = comment.partition("\n")
+            heading = BBCodeToMarkdown(author, MANTIS_TO_GITHUB_USERNAME_MAP)
+            heading.mentions()
+            comments += "### Comment by " + heading.text + "\n"
+            if newline:
+                # Convert with the newline still in front, so that anything that only matches at the start of
+                # a line also matches on the note's first line of text
+                this_comment_text = convert(newline + text)
+                if this_comment_text.startswith("\n"):
+                    this_comment_text = this_comment_text[1:]
+                comments += this_comment_text + "\n"
         comments += "\n"
         return comments
 
@@ -312,6 +674,771 @@ def load_api_key(filename: str) -> Dict[str, str]:
     return api_key
 
 
+def github_headers(api_key: Dict[str, str]) -> Dict[str, str]:
+    return {
+        "Authorization": f"token {api_key['apikey']}",
+        "accept": "application/vnd.github.v3+json",
+    }
+
+
+class RateScheduler:
+    """Spaces out write requests to the GitHub API. The secondary rate limiter that GitHub applies to
+    content-changing requests does not reliably send a Retry-After header, so rather than reacting to it
+    we wait a fixed interval between requests, and pause for longer after every batch of them (unless
+    batch_size is 0). Each call to wait() reserves the next free slot and then sleeps until it without
+    holding the lock, so several threads can each be waiting for (and then making) their own request."""
+
+    def __init__(
+        self,
+        interval: float = GITHUB_REQUEST_INTERVAL,
+        batch_size: int = GITHUB_BATCH_SIZE,
+        batch_pause: float = GITHUB_BATCH_PAUSE,
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.request_count = 0
+        self.next_slot = None
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = now if self.next_slot is None else max(now, self.next_slot)
+            after_batch = (
+                self.batch_size
+                and self.request_count > 0
+                and self.request_count % self.batch_size == 0
+            )
+            self.request_count += 1
+            if self.batch_size and self.request_count % self.batch_size == 0:
+                self.next_slot = slot + self.batch_pause
+            else:
+                self.next_slot = slot + self.interval
+        if after_batch and slot > now:
+            print(
+                f"Avoiding rate limiter by waiting {slot - now:.0f} seconds...",
+                flush=True,
+            )
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def github_request(
+    method: str, url: str, headers: Dict[str, str], scheduler: RateScheduler, **kwargs
+) -> requests.Response:
+    """Make a request once the scheduler allows it, re-trying for as long as GitHub answers with a 403
+    that carries a Retry-After header. Any other response is returned to the caller to deal with."""
+    while True:
+        scheduler.wait()
+        r = requests.request(method, url, headers=headers, **kwargs)
+        if r.status_code == 403 and "Retry-After" in r.headers:
+            wait_for = int(r.headers["Retry-After"])
+            print(f"Hit rate limiter, will re-try in {wait_for} seconds", flush=True)
+            time.sleep(wait_for)
+            continue
+        return r
+
+
+def load_migration_results(filename: str) -> List[Tuple[int, int]]:
+    """Read the (Mantis ID, GitHub issue number) pairs written by the migration, in the order they were
+    written. Malformed lines are skipped."""
+    results = []
+    if not os.path.isfile(filename):
+        return results
+    with open(filename, "r") as f:
+        for line in f:
+            mantis_id, _, github_number = line.strip().partition(",")
+            try:
+                results.append((int(mantis_id), int(github_number)))
+            except ValueError:
+                continue
+    return results
+
+
+def load_migration_map(filename: str) -> Dict[int, int]:
+    """Read the Mantis ID to GitHub issue number map written by the migration. If an issue was migrated
+    more than once, the last migration wins."""
+    return dict(load_migration_results(filename))
+
+
+# Links to a Mantis ticket, except for the "Issue imported from" back-link at the top of each migrated
+# issue, which is meant to keep pointing at Mantis.
+MANTIS_ISSUE_LINK = re.compile(
+    r"(?<!Issue imported from )https?://"
+    + re.escape(MANTIS_TRACKER_URL.partition("://")[2])
+    + r"/view\.php\?id=([0-9]+)"
+)
+
+
+def rewrite_mantis_links(text: str, migration_map: Dict[int, int]) -> str:
+    """Replace links to migrated Mantis tickets with links to the GitHub issue they became. Links to
+    tickets that were not migrated are left alone."""
+
+    def replace(match):
+        mantis_id = int(match.group(1))
+        if mantis_id in migration_map:
+            return f"https://github.com/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/issues/{migration_map[mantis_id]}"
+        return match.group(0)
+
+    return MANTIS_ISSUE_LINK.sub(replace, text)
+
+
+def relink_migrated_issues(github_api_key: Dict[str, str]):
+    """Second pass, run after the migration: rewrite the links to other migrated Mantis tickets in the
+    current body of each migrated issue, and update the issue if (and only if) that changed anything.
+    The issue is not re-rendered from the export, so anything edited on GitHub since is kept. Only the
+    tickets whose Mantis text mentions another ticket are fetched from GitHub."""
+
+    if not os.path.isfile(MANTIS_EXPORT_PATH):
+        print(f"Could not locate {MANTIS_EXPORT_PATH}")
+        return
+
+    migration_map = load_migration_map(MIGRATION_RESULTS_FILE)
+    if not migration_map:
+        print(f"No migrated issues found in {MIGRATION_RESULTS_FILE}")
+        return
+
+    candidates = []
+    with open(MANTIS_EXPORT_PATH, "r", encoding="utf-8", errors="ignore") as f:
+        for row in read_mantis_export(f):
+            if len(row) == 0:
+                continue
+            try:
+                id = int(row[0])
+            except Exception:
+                continue
+            # Most tickets never mention another one: don't bother fetching those
+            if id in migration_map and any(
+                field.contains("view.php?id=") if isinstance(field, LargeField) else "view.php?id=" in field
+                for field in row
+            ):
+                candidates.append(migration_map[id])
+            for field in row:
+                if isinstance(field, LargeField):
+                    field.close()
+
+    print(
+        f"{len(candidates)} of {len(migration_map)} migrated issues may link to other migrated issues",
+        flush=True,
+    )
+
+    headers = github_headers(github_api_key)
+    scheduler = RateScheduler()
+    read_scheduler = RateScheduler(0, 0, 0)  # Reads are not throttled, except by Retry-After
+    updated = 0
+    for github_number in candidates:
+        url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/issues/{github_number}"
+        try:
+            r = github_request("GET", url, headers, read_scheduler)
+            if r.status_code != 200:
+                print(
+                    f"Received a {r.status_code} error when trying to read GitHub issue {github_number}"
+                )
+                continue
+            body = r.json()["body"] or ""
+            new_body = rewrite_mantis_links(body, migration_map)
+            if new_body == body:
+                continue
+            r = github_request("PATCH", url, headers, scheduler, json={"body": new_body})
+        except Exception as e:
+            print(f"Failed to update GitHub issue {github_number}: {e}")
+            continue
+        if r.status_code == 200:
+            updated += 1
+            print(f"Updated links in GitHub issue {github_number}", flush=True)
+        else:
+            print(
+                f"Received a {r.status_code} error when trying to update GitHub issue {github_number}"
+            )
+    print(f"Updated {updated} of {len(candidates)} GitHub issues")
+
+
+# Responses that mean no issue can be migrated (a bad token, the wrong repo, or the rate limiter): rather
+# than recording every remaining issue as a failure, the migration stops
+FATAL_STATUS_CODES = [401, 403, 404, 410]
+
+# Likewise, the migration stops after this many exceptions in a row (e.g. the network is down)
+MAX_CONSECUTIVE_EXCEPTIONS = 3
+
+
+def classify_status(status_code: int) -> str:
+    if status_code == 422:
+        return "unprocessable"
+    if status_code >= 500:
+        return "server_error"
+    return "http_error"
+
+
+def record_dead_letter(
+    mantis_id: int, payload: Optional[Dict], error_class: str, error: str
+):
+    """Append an issue that failed to migrate to the dead-letter file. The payload is None if the issue
+    never got far enough to have one (e.g. its CSV row was malformed)."""
+    print(f"Recording Mantis issue {mantis_id} in {DEAD_LETTER_FILE}", flush=True)
+    entry = {
+        "mantis_id": mantis_id,
+        "error_class": error_class,
+        "error": error,
+        "attempts": 1,
+        "payload": payload,
+    }
+    with open(DEAD_LETTER_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def load_dead_letters() -> List[Dict]:
+    dead_letters = []
+    if not os.path.isfile(DEAD_LETTER_FILE):
+        return dead_letters
+    with open(DEAD_LETTER_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                dead_letters.append(json.loads(line))
+    return dead_letters
+
+
+def save_dead_letters(dead_letters: List[Dict]):
+    temp_file = DEAD_LETTER_FILE + ".tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        for entry in dead_letters:
+            f.write(json.dumps(entry) + "\n")
+    os.replace(temp_file, DEAD_LETTER_FILE)
+
+
+def _retry_unchanged(payload: Dict) -> Optional[Dict]:
+    return payload
+
+
+def _retry_without_assignees(payload: Dict) -> Optional[Dict]:
+    # By far the most common cause of a 422 is an assignee without the necessary permissions in
+    # the repo: try again without any assignees, they can be fixed up by hand afterwards
+    if not payload.get("assignees"):
+        return None
+    return {key: value for key, value in payload.items() if key != "assignees"}
+
+
+# How each class of failure is retried: the policy returns the payload to re-send, or None if retrying
+# would not help and the entry should stay in the queue for a human to look at. Issues that failed with
+# an exception (e.g. a timeout) may have been created anyway, so they are only re-sent if no issue in the
+# repo is marked as imported from them. Issues that GitHub reported as created ("created") never are.
+DEAD_LETTER_RETRY_POLICIES = {
+    "unprocessable": _retry_without_assignees,
+    "server_error": _retry_unchanged,
+    "http_error": _retry_unchanged,
+    "exception": _retry_unchanged,
+}
+
+
+def retry_dead_letters(github_api_key: Dict[str, str]):
+    """Replay the dead-letter queue. Issues that migrate successfully are appended to the migration
+    results and removed from the queue, everything else stays in it (with its new error, if any)."""
+
+    dead_letters = load_dead_letters()
+    if not dead_letters:
+        print(f"No failed issues found in {DEAD_LETTER_FILE}")
+        return
+
+    url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/issues"
+    headers = github_headers(github_api_key)
+    scheduler = RateScheduler()
+    remaining = []
+    migrated = 0
+    already_migrated = None  # Mantis ID -> GitHub issue number, listed only if it is needed
+    entry = None  # The entry being retried, until its outcome has been recorded
+    posted = False  # Whether that entry may already have been sent to GitHub
+    try:
+        while dead_letters:
+            entry = dead_letters.pop(0)
+            posted = False
+
+            if entry["error_class"] in ["exception", "created"]:
+                if already_migrated is None:
+                    already_migrated = {
+                        mantis_id: number
+                        for number, mantis_id in list_github_issues(github_api_key)
+                        if mantis_id is not None
+                    }
+                if entry["mantis_id"] in already_migrated:
+                    number = already_migrated[entry["mantis_id"]]
+                    print(
+                        f"Mantis issue {entry['mantis_id']} was already migrated to GitHub issue {number}",
+                        flush=True,
+                    )
+                    with open(MIGRATION_RESULTS_FILE, "a") as f:
+                        f.write(f"{entry['mantis_id']},{number}\n")
+                    migrated += 1
+                    entry = None
+                    continue
+
+            policy = DEAD_LETTER_RETRY_POLICIES.get(entry["error_class"])
+            payload = entry["payload"]
+            if policy is not None and payload is not None:
+                payload = policy(payload)
+            if policy is None or payload is None:
+                print(
+                    f"Not retrying Mantis issue {entry['mantis_id']} ({entry['error_class']}): {entry['error']}"
+                )
+                remaining.append(entry)
+                entry = None
+                continue
+
+            entry["attempts"] += 1
+            try:
+                posted = True
+                r = github_request("POST", url, headers, scheduler, json=payload)
+            except Exception as e:
+                entry["error_class"] = "exception"
+                entry["error"] = str(e)
+                remaining.append(entry)
+                entry = None
+                continue
+            if r.status_code == 201:
+                try:
+                    response = r.json()
+                    number = response["number"]
+                except Exception as e:
+                    entry["error_class"] = "created"
+                    entry["error"] = str(e)
+                    remaining.append(entry)
+                    entry = None
+                    continue
+                print(
+                    f"Mantis issue {entry['mantis_id']} migrated to GitHub issue {number} ({response.get('html_url')})",
+                    flush=True,
+                )
+                with open(MIGRATION_RESULTS_FILE, "a") as f:
+                    f.write(f"{entry['mantis_id']},{number}\n")
+                if already_migrated is not None:
+                    already_migrated[entry["mantis_id"]] = number
+                migrated += 1
+                entry = None
+            elif r.status_code in FATAL_STATUS_CODES:
+                # Rate limited without a Retry-After header, or a problem with the token or the repo:
+                # nothing more can be done for now
+                print(f"Received a {r.status_code} error from GitHub. Stopping.")
+                remaining.append(entry)
+                entry = None
+                break
+            else:
+                print(
+                    f"Received a {r.status_code} error when trying to migrate issue {entry['mantis_id']}: {r.text}"
+                )
+                entry["error_class"] = classify_status(r.status_code)
+                entry["error"] = r.text
+                entry["payload"] = payload
+                remaining.append(entry)
+                entry = None
+    finally:
+        if entry is not None:
+            # Interrupted before this entry's outcome was known: keep it, and if it may have been sent,
+            # make sure the next retry checks whether it was created before sending it again
+            if posted:
+                entry["error_class"] = "exception"
+                entry["error"] = "Interrupted while retrying"
+            remaining.append(entry)
+        save_dead_letters(remaining + dead_letters)
+
+    print(
+        f"Migrated {migrated} issues, {len(remaining) + len(dead_letters)} remain in {DEAD_LETTER_FILE}"
+    )
+
+
+# The back-link at the top of every migrated issue (see Issue._create_markdown)
+MIGRATED_ISSUE_MARKER = re.compile(r"Issue imported from \S*view\.php\?id=([0-9]+)")
+
+
+def list_github_issues(github_api_key: Dict[str, str]) -> List[List[Optional[int]]]:
+    """List every issue (but not pull request) in the GitHub repo as a [number, mantis_id] pair, where
+    mantis_id is None for issues that were not migrated from Mantis. Pages are requested oldest-first so
+    that new issues only ever change the last page, and with the ETag from the previous run, so GitHub
+    answers "304 Not Modified" (which does not count against the rate limit) for unchanged pages. The
+    listing ends at the first page that is not full, so a full last page is always followed by a request
+    for the page after it, in case new issues were created since the last run."""
+
+    cache = {}
+    if os.path.isfile(GITHUB_ISSUE_LIST_CACHE):
+        with open(GITHUB_ISSUE_LIST_CACHE, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+
+    per_page = 100
+    base_url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/issues?state=all&sort=created&direction=asc&per_page={per_page}"
+    issues = []
+    pages_changed = 0
+    page_number = 1
+    while True:
+        url = f"{base_url}&page={page_number}"
+        headers = github_headers(github_api_key)
+        if url in cache:
+            headers["If-None-Match"] = cache[url]["etag"]
+        r = requests.get(url, headers=headers)
+        if r.status_code == 304:
+            page = cache[url]
+        elif r.status_code == 200:
+            pages_changed += 1
+            items = r.json()
+            page = {
+                "etag": r.headers.get("ETag", ""),
+                "count": len(items),  # Including pull requests, which are not kept
+                "issues": [],
+            }
+            for issue in items:
+                if "pull_request" in issue:
+                    continue
+                marker = MIGRATED_ISSUE_MARKER.search(issue["body"] or "")
+                mantis_id = int(marker.group(1)) if marker else None
+                page["issues"].append([issue["number"], mantis_id])
+            if page["etag"]:
+                cache[url] = page
+        elif r.status_code == 403 and "Retry-After" in r.headers:
+            wait_for = int(r.headers["Retry-After"])
+            print(f"Hit rate limiter, will re-try in {wait_for} seconds", flush=True)
+            time.sleep(wait_for)
+            continue
+        else:
+            raise RuntimeError(
+                f"Received a {r.status_code} error when listing GitHub issues: {r.text}"
+            )
+        issues.extend(page["issues"])
+        if page["count"] < per_page:
+            break
+        page_number += 1
+
+    with open(GITHUB_ISSUE_LIST_CACHE, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    print(f"Listed {len(issues)} GitHub issues ({pages_changed} pages changed)")
+    return issues
+
+
+def verify_migration(github_api_key: Dict[str, str]):
+    """Check the migration results against the issues that actually exist on GitHub, and report:
+    * missing: a recorded GitHub issue that does not exist, or is not marked with its Mantis ID
+    * duplicated: a Mantis ID that more than one GitHub issue is marked with
+    * orphaned: a GitHub issue marked with a Mantis ID, but not recorded in the migration results"""
+
+    results = load_migration_results(MIGRATION_RESULTS_FILE)
+    issues = list_github_issues(github_api_key)
+
+    mantis_id_by_number = {}
+    numbers_by_mantis_id = {}
+    for number, mantis_id in issues:
+        mantis_id_by_number[number] = mantis_id
+        if mantis_id is not None:
+            numbers_by_mantis_id.setdefault(mantis_id, []).append(number)
+
+    missing = [
+        (mantis_id, number)
+        for mantis_id, number in results
+        if mantis_id_by_number.get(number) != mantis_id
+    ]
+    duplicated = {
+        mantis_id: numbers
+        for mantis_id, numbers in numbers_by_mantis_id.items()
+        if len(numbers) > 1
+    }
+    recorded_numbers = set(number for _, number in results)
+    orphaned = [
+        (mantis_id, number)
+        for number, mantis_id in issues
+        if mantis_id is not None and number not in recorded_numbers
+    ]
+
+    for mantis_id, number in missing:
+        if number in mantis_id_by_number:
+            print(
+                f"MISSING: Mantis issue {mantis_id} was recorded as GitHub issue {number}, which is not marked with it"
+            )
+        else:
+            print(
+                f"MISSING: Mantis issue {mantis_id} was recorded as GitHub issue {number}, which does not exist"
+            )
+    for mantis_id, numbers in duplicated.items():
+        print(
+            f"DUPLICATED: Mantis issue {mantis_id} was migrated to GitHub issues {', '.join(str(n) for n in numbers)}"
+        )
+    for mantis_id, number in orphaned:
+        print(
+            f"ORPHANED: GitHub issue {number} was imported from Mantis issue {mantis_id}, but is not in {MIGRATION_RESULTS_FILE}"
+        )
+
+    print("*" * 90)
+    print("VERIFICATION SUMMARY")
+    print("*" * 90)
+    print(f"{len(results)} migrations recorded in {MIGRATION_RESULTS_FILE}")
+    print(f"{len(missing)} missing, {len(duplicated)} duplicated, {len(orphaned)} orphaned")
+
+
+def load_attachments(filename: str) -> Dict[int, List[Dict[str, str]]]:
+    """Read the Mantis bug file table export (which must have a header row naming its columns) into a
+    map from Mantis bug ID to that bug's attachments."""
+    attachments = {}
+    if not os.path.isfile(filename):
+        return attachments
+    with open(filename, "r", encoding="utf-8", errors="ignore") as f:
+        for row in csv_iteration_wrapper(csv.DictReader(f)):
+            try:
+                bug_id = int(row["bug_id"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            attachment = {
+                "diskfile": os.path.basename(row["diskfile"]),
+                "filename": os.path.basename(row["filename"] or row["diskfile"]),
+            }
+            attachments.setdefault(bug_id, []).append(attachment)
+    return attachments
+
+
+def load_attachment_manifest() -> Dict[str, str]:
+    if not os.path.isfile(ATTACHMENT_MANIFEST):
+        return {}
+    with open(ATTACHMENT_MANIFEST, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_attachment_links() -> Dict[int, List[Tuple[str, str]]]:
+    """Map each Mantis bug ID to the (filename, url) of each of its attachments that has been uploaded."""
+    manifest = load_attachment_manifest()
+    links = {}
+    for bug_id, attachments in load_attachments(MANTIS_ATTACHMENTS_TABLE).items():
+        for attachment in attachments:
+            if attachment["diskfile"] in manifest:
+                links.setdefault(bug_id, []).append(
+                    (attachment["filename"], manifest[attachment["diskfile"]])
+                )
+    return links
+
+
+class LocalAttachmentStore:
+    """Uploads attachments by copying them into a local directory that is served elsewhere."""
+
+    def __init__(self, directory: str, base_url: str):
+        self.directory = directory
+        self.base_url = base_url
+        self.uploaded = []
+        self.lock = threading.Lock()
+
+    def existing(self) -> Set[str]:
+        present = set()
+        if os.path.isdir(self.directory):
+            for folder in os.listdir(self.directory):
+                for filename in os.listdir(os.path.join(self.directory, folder)):
+                    present.add(f"{folder}/{filename}")
+        return present
+
+    def upload(self, path: str, source: str):
+        destination = os.path.join(self.directory, *path.split("/"))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copyfile(source, destination)
+        with self.lock:
+            self.uploaded.append(path)
+
+    def commit(self) -> List[str]:
+        """Return the paths uploaded since the last commit: copied files are available right away."""
+        with self.lock:
+            committed, self.uploaded = self.uploaded, []
+        return committed
+
+    def url(self, path: str) -> str:
+        return self.base_url + urllib.parse.quote(path)
+
+
+class GitHubAttachmentStore:
+    """Uploads attachments to a branch of the GitHub repo. Each file is uploaded as a git blob (which can
+    be done concurrently), and the uploaded blobs are added to the branch a batch at a time by commit()."""
+
+    def __init__(self, github_api_key: Dict[str, str], branch: str):
+        self.headers = github_headers(github_api_key)
+        self.branch = branch
+        self.api_url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/git"
+        self.scheduler = RateScheduler(
+            GITHUB_UPLOAD_REQUEST_INTERVAL,
+            GITHUB_UPLOAD_BATCH_SIZE,
+            GITHUB_UPLOAD_BATCH_PAUSE,
+        )
+        self.parent_commit = None
+        self.base_tree = None
+        self.new_entries = []
+        self.lock = threading.Lock()
+
+    def _request(self, method: str, url: str, expected_status: int, **kwargs) -> Dict:
+        r = github_request(method, url, self.headers, self.scheduler, **kwargs)
+        if r.status_code != expected_status:
+            raise RuntimeError(
+                f"Received a {r.status_code} error from {method} {url}: {r.text}"
+            )
+        return r.json()
+
+    def _get(self, url: str) -> Dict:
+        r = requests.get(url, headers=self.headers)
+        if r.status_code != 200:
+            raise RuntimeError(f"Received a {r.status_code} error from GET {url}: {r.text}")
+        return r.json()
+
+    def existing(self) -> Set[str]:
+        r = requests.get(f"{self.api_url}/ref/heads/{self.branch}", headers=self.headers)
+        if r.status_code == 404:
+            return set()  # The branch will be created by the first commit()
+        if r.status_code != 200:
+            raise RuntimeError(
+                f"Received a {r.status_code} error looking up branch {self.branch}: {r.text}"
+            )
+        self.parent_commit = r.json()["object"]["sha"]
+        commit = self._get(f"{self.api_url}/commits/{self.parent_commit}")
+        self.base_tree = commit["tree"]["sha"]
+        tree = self._get(f"{self.api_url}/trees/{self.base_tree}?recursive=1")
+        if not tree["truncated"]:
+            return set(
+                entry["path"] for entry in tree["tree"] if entry["type"] == "blob"
+            )
+        # Too big to list in one go: walk the tree one level at a time instead
+        return self._walk_tree(self.base_tree, "")
+
+    def _walk_tree(self, tree_sha: str, prefix: str) -> Set[str]:
+        paths = set()
+        tree = self._get(f"{self.api_url}/trees/{tree_sha}")
+        if tree["truncated"]:
+            raise RuntimeError(
+                f"The listing of {prefix or 'the top level'} of branch {self.branch} was truncated"
+            )
+        for entry in tree["tree"]:
+            if entry["type"] == "blob":
+                paths.add(prefix + entry["path"])
+            elif entry["type"] == "tree":
+                paths |= self._walk_tree(entry["sha"], prefix + entry["path"] + "/")
+        return paths
+
+    def upload(self, path: str, source: str):
+        with open(source, "rb") as f:
+            content = base64.b64encode(f.read()).decode("ascii")
+        blob = self._request(
+            "POST",
+            f"{self.api_url}/blobs",
+            201,
+            json={"content": content, "encoding": "base64"},
+        )
+        with self.lock:
+            self.new_entries.append(
+                {"path": path, "mode": "100644", "type": "blob", "sha": blob["sha"]}
+            )
+
+    def commit(self) -> List[str]:
+        """Commit the blobs uploaded since the last commit to the branch, and return their paths."""
+        with self.lock:
+            entries, self.new_entries = self.new_entries, []
+        if not entries:
+            return []
+        try:
+            self._commit(entries)
+        except Exception:
+            with self.lock:
+                self.new_entries = entries + self.new_entries
+            raise
+        return [entry["path"] for entry in entries]
+
+    def _commit(self, entries: List[Dict[str, str]]):
+        tree_data = {"tree": entries}
+        if self.base_tree:
+            tree_data["base_tree"] = self.base_tree
+        tree = self._request("POST", f"{self.api_url}/trees", 201, json=tree_data)
+        commit = self._request(
+            "POST",
+            f"{self.api_url}/commits",
+            201,
+            json={
+                "message": f"Add {len(entries)} attachments migrated from Mantis",
+                "tree": tree["sha"],
+                "parents": [self.parent_commit] if self.parent_commit else [],
+            },
+        )
+        if self.parent_commit:
+            self._request(
+                "PATCH",
+                f"{self.api_url}/refs/heads/{self.branch}",
+                200,
+                json={"sha": commit["sha"]},
+            )
+        else:
+            self._request(
+                "POST",
+                f"{self.api_url}/refs",
+                201,
+                json={"ref": f"refs/heads/{self.branch}", "sha": commit["sha"]},
+            )
+        self.parent_commit = commit["sha"]
+        self.base_tree = tree["sha"]
+
+    def url(self, path: str) -> str:
+        return f"https://github.com/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/blob/{self.branch}/{urllib.parse.quote(path)}?raw=true"
+
+
+def upload_attachments(github_api_key: Dict[str, str]):
+    """Upload every attachment that is not already in the manifest (or already in the store), once per
+    unique file, and record the links in the manifest."""
+
+    if ATTACHMENT_STORE == "local":
+        store = LocalAttachmentStore(LOCAL_ATTACHMENTS_DIR, LOCAL_ATTACHMENTS_URL)
+    else:
+        store = GitHubAttachmentStore(github_api_key, GITHUB_ATTACHMENTS_BRANCH)
+
+    manifest = load_attachment_manifest()
+    already_uploaded = store.existing()
+    to_upload = {}  # diskfile -> path in the store
+    for attachments in load_attachments(MANTIS_ATTACHMENTS_TABLE).values():
+        for attachment in attachments:
+            diskfile = attachment["diskfile"]
+            if diskfile in manifest or diskfile in to_upload:
+                continue
+            # The files are named by their hash, so identical attachments share a folder: the first
+            # filename it was attached with is the one used
+            path = f"{diskfile}/{attachment['filename']}"
+            if path in already_uploaded:
+                manifest[diskfile] = store.url(path)
+            elif os.path.isfile(os.path.join(MANTIS_ATTACHMENTS_DIR, diskfile)):
+                to_upload[diskfile] = path
+            else:
+                print(f"WARNING: attachment {diskfile} not found in {MANTIS_ATTACHMENTS_DIR}")
+
+    diskfile_by_path = {path: diskfile for diskfile, path in to_upload.items()}
+    committed = 0
+
+    def commit_and_save():
+        # Only committed uploads go in the manifest: anything else is uploaded again next time
+        nonlocal committed
+        paths = store.commit()
+        for path in paths:
+            manifest[diskfile_by_path[path]] = store.url(path)
+        with open(ATTACHMENT_MANIFEST, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        committed += len(paths)
+
+    print(f"Uploading {len(to_upload)} attachments", flush=True)
+    executor = concurrent.futures.ThreadPoolExecutor(ATTACHMENT_UPLOAD_THREADS)
+    try:
+        futures = {
+            executor.submit(
+                store.upload, path, os.path.join(MANTIS_ATTACHMENTS_DIR, diskfile)
+            ): diskfile
+            for diskfile, path in to_upload.items()
+        }
+        uploaded_since_commit = 0
+        for future in concurrent.futures.as_completed(futures):
+            diskfile = futures[future]
+            try:
+                future.result()
+                uploaded_since_commit += 1
+            except Exception as e:
+                print(f"Failed to upload attachment {diskfile}: {e}")
+            if uploaded_since_commit >= ATTACHMENT_COMMIT_BATCH_SIZE:
+                commit_and_save()
+                uploaded_since_commit = 0
+                print(f"{committed} attachments uploaded so far", flush=True)
+    finally:
+        # On an error or Ctrl-C, don't start any more uploads, but keep the ones already done
+        executor.shutdown(wait=True, cancel_futures=True)
+        commit_and_save()
+    print(f"Uploaded {committed} attachments, {len(manifest)} are now available")
+
+
 def csv_iteration_wrapper(csv_iterator):
     """Iteration over the CSV might encounter all manner of errors: turn them into warnings."""
 
@@ -332,26 +1459,47 @@ if __name__ == "__main__":
 
     github_api_key = load_api_key(GITHUB_API_TOKEN_FILE)
 
+    counter = 0
+    sys.stdout.reconfigure(encoding="utf-8")  # Beat MSYS2 into submission
+
+    # On the command line, "relink" rewrites the links between already-migrated issues instead of
+    # migrating anything
+    if len(sys.argv) > 1 and sys.argv[1] == "relink":
+        relink_migrated_issues(github_api_key)
+        exit(0)
+
+    # ... and "retry" replays the issues that failed to migrate
+    if len(sys.argv) > 1 and sys.argv[1] == "retry":
+        retry_dead_letters(github_api_key)
+        exit(0)
+
+    # ... and "attachments" uploads the attachments, to be linked from the issues when they are migrated
+    if len(sys.argv) > 1 and sys.argv[1] == "attachments":
+        upload_attachments(github_api_key)
+        exit(0)
+
+    # ... and "verify" checks the migration results against what is actually on GitHub
+    if len(sys.argv) > 1 and sys.argv[1] == "verify":
+        verify_migration(github_api_key)
+        exit(0)
+
     if not os.path.isfile(MANTIS_EXPORT_PATH):
         print(f"Could not locate {MANTIS_EXPORT_PATH}")
         exit(1)
 
-    counter = 0
-    sys.stdout.reconfigure(encoding="utf-8")  # Beat MSYS2 into submission
-
     # On the command line, if an argument is passed it is the issue ID to start at
     trigger_start_at_issue = None
     if len(sys.argv) > 1:
         trigger_start_at_issue = int(sys.argv[1])
 
+    attachment_links = load_attachment_links()
     result_database = {}
     row_counter = 0
     with open(MANTIS_EXPORT_PATH, "r", encoding="utf-8", errors="ignore") as f:
-        csv.field_size_limit(2147483647)  # Some of these bug reports are very large...
-        csv_reader = csv.reader(f, delimiter=",", quotechar='"')
-
         stop = False
-        for row in csv_iteration_wrapper(csv_reader):
+        consecutive_exceptions = 0
+        scheduler = RateScheduler()
+        for row in read_mantis_export(f):  # Some of these bug reports are very large...
             if stop:
                 break
             row_counter += 1
@@ -369,91 +1517,79 @@ if __name__ == "__main__":
                             continue
 
                     print(f"Processing issue ID {id}", flush=True)
-                    issue = Issue(row)
+                    issue = Issue(row, attachment_links.get(id, []))
                     counter += 1
 
                     url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/issues"
-                    headers = {
-                        "Authorization": f"token {github_api_key['apikey']}",
-                        "accept": "application/vnd.github.v3+json",
-                    }
+                    headers = github_headers(github_api_key)
 
+                    fields = None
+                    r = None
                     try:
-                        try_again = True
-                        while try_again and not stop:
-                            r = requests.post(
-                                url, headers=headers, json=issue.to_github_api_fields()
+                        fields = issue.to_github_api_fields()
+                        issue.close()
+                        r = github_request(
+                            "POST", url, headers, scheduler, json=fields
+                        )
+                        consecutive_exceptions = 0
+                        if r.status_code == 201:
+                            response = r.json()
+                            print(
+                                f"{row_counter}: Mantis issue {id} migrated to GitHub issue {response['number']} ({response['html_url']})",
+                                flush=True,
+                            )
+                            result_database[id] = response["number"]
+                        elif r.status_code == 403:
+                            # A 403 without a Retry-After header is expected for creation of issues,
+                            # which GitHub throttles further because it sends notifications: the
+                            # scheduler works around it by pausing after every batch of issues, but
+                            # that may not be enough. Just stop here, and emit a message. The user
+                            # will have to manually restart.
+                            print(
+                                f"Received a 403 error when trying to migrate issue {id}. Stopping."
+                            )
+                            print(r.headers)
+                            stop = True
+                        elif r.status_code in FATAL_STATUS_CODES:
+                            # Not a problem with this issue: every other one would fail the same way
+                            print(
+                                f"Received a {r.status_code} error when trying to migrate issue {id}: {r.text}"
+                            )
+                            print(f"Stopping: restart from issue {id} once this is fixed.")
+                            stop = True
+                        else:
+                            # Unprocessable entity, or something unexpected: set this one aside and
+                            # carry on with the rest
+                            print(
+                                f"Received a {r.status_code} error when trying to migrate issue {id}: {r.text}"
+                            )
+                            record_dead_letter(
+                                id, fields, classify_status(r.status_code), r.text
                             )
-                            if r.status_code == 201:
-                                try_again = False
-                                response = r.json()
-
-                                print(
-                                    f"{row_counter}: Mantis issue {id} migrated to GitHub issue {response['number']} ({response['html_url']})",
-                                    flush=True,
-                                )
-                                result_database[id] = response["number"]
-                                time.sleep(
-                                    1
-                                )  # Avoid the secondary rate limiter by waiting one second between requests
-                                if row_counter % 10 == 0:
-                                    # Because creating issues sends notifications, GitHub further throttles issue creation.
-                                    # Every ten issues, pause for a minute to try to avoid that rate limit (which does not
-                                    # send a Retry-After header).
-                                    print(
-                                        "Avoiding rate limiter by waiting one minute...",
-                                        flush=True,
-                                    )
-                                    for i in range(6):
-                                        print(
-                                            f"{60-i*10} seconds remaining", flush=True
-                                        )
-                                        time.sleep(10)
-                                    print("Continuing...", flush=True)
-                            elif r.status_code == 403:
-                                # Probably we hit a rate limit: check for the try_again header
-                                if "Retry-After" in r.headers:
-                                    wait_for = int(r.headers["Retry-After"])
-                                    print(
-                                        f"Hit rate limiter, will re-try in {wait_for} seconds",
-                                        flush=True,
-                                    )
-                                    time.sleep(wait_for)
-                                else:
-                                    # This is expected for creation of issues: we try to
-                                    # work around it above by sleeping for a minute after
-                                    # every ten issues, but that may not be enough. Just
-                                    # stop here, and emit a message. The user will have
-                                    # to manually restart.
-                                    print(
-                                        f"Received a 403 error when trying to migrate issue {id}. Stopping."
-                                    )
-                                    print(r.headers)
-                                    stop = True
-                            elif r.status_code == 422:
-                                # Unprocessable entity: print the whole message
-                                print (r.json())
-                                stop = True
-                            else:
-                                print(
-                                    f"Received a {r.status_code} error when trying to migrate issue {id}. Stopping."
-                                )
-                                stop = True
 
                     except Exception as e:
-                        print("Failed to create GitHub issue:")
-                        print(url)
-                        print(headers)
-                        print(e)
-                        stop = True
+                        print(f"Failed to create GitHub issue for Mantis issue {id}: {e}")
+                        # If GitHub had already answered 201, the issue exists: it must not be re-sent
+                        error_class = "exception"
+                        if r is not None and r.status_code == 201:
+                            error_class = "created"
+                        else:
+                            consecutive_exceptions += 1
+                        if consecutive_exceptions >= MAX_CONSECUTIVE_EXCEPTIONS:
+                            print(
+                                f"{consecutive_exceptions} failures in a row. Stopping: restart from issue {id} once this is fixed."
+                            )
+                            stop = True
+                        else:
+                            record_dead_letter(id, fields, error_class, str(e))
 
             except RuntimeError as e:
                 print(e)
-                stop = True
+                record_dead_letter(id, None, "malformed", str(e))
 
         if len(result_database) > 0:
-            print("Appending results to migration_results.csv")
-            with open("migration_results.csv", "a") as f:
+            print(f"Appending results to {MIGRATION_RESULTS_FILE}")
+            with open(MIGRATION_RESULTS_FILE, "a") as f:
                 for mantis, github in result_database.items():
                     f.write(f"{mantis},{github}\n")
 